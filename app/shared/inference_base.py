@@ -9,20 +9,28 @@ this module and supply a InferenceAppConfig.
 from __future__ import annotations
 
 import os
-import json
 import asyncio
+import functools
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import TYPE_CHECKING, Optional, List
 
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from huggingface_hub import hf_hub_download
-from llama_cpp import Llama
+from pydantic import BaseModel, ConfigDict
+
+from server_utils import json_response, metrics_response, mlock_fits, prefetch_model
+
+# huggingface_hub and llama_cpp are imported where they are used: loading the
+# native llama.cpp library is slow and not needed until the model is loaded.
+if TYPE_CHECKING:
+    from llama_cpp import Llama
 
 # Clamp BLAS thread pools so llama.cpp controls CPU usage
 if not os.getenv("OPENBLAS_NUM_THREADS"):
@@ -30,6 +38,29 @@ if not os.getenv("OPENBLAS_NUM_THREADS"):
 if not os.getenv("OMP_NUM_THREADS"):
     os.environ["OMP_NUM_THREADS"] = "1"
 
+# Max streamed chunks buffered between the llm thread and the SSE response
+STREAM_QUEUE_SIZE = 16
+
+SSE_DONE = b"data: [DONE]\n\n"
+# SSE comment sent while a stream waits for its first token (queued behind other
+# requests or in long prefills) so proxies and tunnels don't drop it as idle
+SSE_KEEPALIVE = b": keepalive\n\n"
+SSE_KEEPALIVE_SECONDS = 15
+
+# llama.cpp ggml_numa_strategy values, selected with the NUMA env var
+NUMA_STRATEGIES = {"distribute": 1, "isolate": 2, "numactl": 3}
+
+
+def _sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def _delta_content(chunk: Optional[dict]) -> Optional[str]:
+    """Content of a streamed chat chunk, or None for role/finish/end-of-stream chunks."""
+    if not chunk or not chunk.get("choices"):
+        return None
+    return chunk["choices"][0].get("delta", {}).get("content")
+
 @dataclass
 class InferenceAppConfig:
     # FastAPI metadata
@@ -51,8 +82,11 @@ class InferenceAppConfig:
     # llama.cpp tuning - 4 threads matches GitHub Actions ARM runner vCPUs
     default_n_ctx: int = 4096
     default_n_threads: int = 4
-    n_batch: int = 256
+    n_batch: int = 2048
+    n_ubatch: int = 512
     last_n_tokens_size: int = 64
+    use_mlock: bool = False
+    use_mmap: bool = True
 
 
 class ChatMessage(BaseModel):
@@ -69,17 +103,22 @@ class GenerateRequest(BaseModel):
     stream: bool = False
     include_perf: bool = False
 
-    class Config:
-        extra = 'ignore'  # allow OpenAI-style extra fields like 'model', 'tools', etc.
+    model_config = ConfigDict(extra='ignore')  # allow OpenAI-style extra fields like 'model', 'tools', etc.
 
 
-def _env_bool(name: str) -> bool:
-    return os.getenv(name, "").strip().lower() in {"1", "true", "yes", "on"}
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
 
 
-def _download_model(default_repo: str, default_file: str) -> str:
-    repo_id = os.getenv("MODEL_REPO", default_repo)
-    filename = os.getenv("MODEL_FILE", default_file)
+def _model_source(default_repo: str, default_file: str) -> tuple[str, str]:
+    return os.getenv("MODEL_REPO", default_repo), os.getenv("MODEL_FILE", default_file)
+
+
+def _download_model(repo_id: str, filename: str) -> str:
+    from huggingface_hub import hf_hub_download
 
     print(f"Downloading model: {repo_id}/{filename}")
     model_path = hf_hub_download(
@@ -112,6 +151,9 @@ def create_app_for_model(model_name: str) -> FastAPI:
         default_n_ctx=model.n_ctx,
         default_n_threads=model.n_threads,
         n_batch=model.n_batch,
+        n_ubatch=model.n_ubatch,
+        use_mlock=model.use_mlock,
+        use_mmap=model.use_mmap,
     )
 
     return create_inference_app(config)
@@ -120,8 +162,9 @@ def create_app_for_model(model_name: str) -> FastAPI:
 def create_inference_app(config: InferenceAppConfig) -> FastAPI:
     @asynccontextmanager
     async def lifespan(app: FastAPI):
-        await asyncio.to_thread(_load_model)
+        await _run_llm(_load_model)
         yield
+        llm_executor.shutdown(wait=False, cancel_futures=True)
 
     app = FastAPI(
         title=config.title,
@@ -137,19 +180,48 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
         allow_headers=["*"],
     )
 
-    # Model state and concurrency gate
+    # Model state. llama.cpp contexts are not reentrant, so a single dedicated
+    # worker thread owns every call into `llm` that touches the context; this also
+    # serializes requests. The one exception is llm.tokenize for prompt token
+    # counts, which only reads the vocab and so runs on the event loop.
     llm: Optional[Llama] = None
+    llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+    model_key = _model_source(config.default_repo, config.default_file)
     n_ctx = int(os.getenv("N_CTX", str(config.default_n_ctx)))
     n_threads = int(os.getenv("N_THREADS", str(config.default_n_threads)))
+    # Prompt prefill is compute-bound and can use more threads than memory-bound
+    # decode; opt-in, since n_threads is already sized to the model's CPU share
+    n_threads_batch = int(os.getenv("N_THREADS_BATCH", str(n_threads)))
     n_batch = int(os.getenv("N_BATCH", str(config.n_batch)))
-    max_concurrent = int(os.getenv("MAX_CONCURRENT", "2"))
-    inference_lock = asyncio.Semaphore(max_concurrent)
+    n_ubatch = int(os.getenv("N_UBATCH", str(config.n_ubatch)))
+    # Layers offloaded to the GPU (-1 = all); only takes effect in a CUDA/Metal build
+    n_gpu_layers = int(os.getenv("N_GPU_LAYERS", "0"))
+    use_mlock = _env_bool("USE_MLOCK", config.use_mlock)
+    use_mmap = _env_bool("USE_MMAP", config.use_mmap)
     always_include_perf = _env_bool("ALWAYS_INCLUDE_PERF")
     log_perf = _env_bool("LOG_PERF")
+    # llama.cpp only keeps the KV state of the last prompt; a RAM prompt cache also
+    # keeps earlier conversations' states so interleaved multi-turn chats skip
+    # re-prefilling their shared history. Off by default: each save copies the KV.
+    prompt_cache_mb = int(os.getenv("PROMPT_CACHE_MB", "0"))
+    # Max tokens merged into one SSE frame when the client falls behind; 1 keeps one frame per token
+    sse_batch = max(1, int(os.getenv("SSE_BATCH", "4")))
+    # Cumulative counters exported on /metrics
+    stats = {
+        "requests_total": 0,
+        "stream_requests_total": 0,
+        "errors_total": 0,
+        "prompt_tokens_total": 0,
+        "completion_tokens_total": 0,
+    }
 
     def _load_model():
-        nonlocal llm
-        model_path = _download_model(config.default_repo, config.default_file)
+        nonlocal llm, use_mlock
+        model_path = _download_model(*model_key)
+        if use_mmap:
+            prefetch_model(model_path)
+        if use_mlock:
+            use_mlock = mlock_fits(model_path)
 
         # KV-cache quantization (Q8_0) requires flash_attn
         kv_cache_quant = os.getenv("KV_CACHE_QUANT", "").strip().lower()
@@ -162,7 +234,12 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
             type_v = 8  # Q8_0
             flash_attn = True  # Required for KV-cache quantization
 
-        print(f"Loading model with n_ctx={n_ctx}, n_threads={n_threads}, n_batch={n_batch}, max_concurrent={max_concurrent}, flash_attn={flash_attn}")
+        # NUMA placement only pays off on multi-socket hosts; off by default
+        numa = os.getenv("NUMA", "").strip().lower()
+        if numa and numa not in NUMA_STRATEGIES:
+            raise ValueError(f"Unknown NUMA strategy '{numa}'. Use one of: {', '.join(NUMA_STRATEGIES)}")
+
+        print(f"Loading model with n_ctx={n_ctx}, n_threads={n_threads}, n_threads_batch={n_threads_batch}, n_batch={n_batch}, n_ubatch={n_ubatch}, use_mlock={use_mlock}, use_mmap={use_mmap}, flash_attn={flash_attn}")
         if type_k:
             print(f"  KV-cache quantization enabled: type_k={type_k}, type_v={type_v}")
 
@@ -170,11 +247,15 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
             "model_path": model_path,
             "n_ctx": n_ctx,
             "n_threads": n_threads,
-            "use_mlock": True,
-            "use_mmap": True,
+            "n_threads_batch": n_threads_batch,
+            "use_mlock": use_mlock,
+            "use_mmap": use_mmap,
             "n_batch": n_batch,
+            "n_ubatch": n_ubatch,
             "last_n_tokens_size": config.last_n_tokens_size,
-            "verbose": True,
+            # verbose makes llama.cpp print prefix-match and timing lines to stderr
+            # on every completion; LLAMA_VERBOSE=1 brings them back for debugging
+            "verbose": _env_bool("LLAMA_VERBOSE"),
         }
         if config.chat_format:
             llama_kwargs["chat_format"] = config.chat_format
@@ -184,29 +265,44 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
         if type_k is not None:
             llama_kwargs["type_k"] = type_k
             llama_kwargs["type_v"] = type_v
+        if n_gpu_layers:
+            llama_kwargs["n_gpu_layers"] = n_gpu_layers
+            print(f"  GPU offload: n_gpu_layers={n_gpu_layers}")
+        if numa:
+            llama_kwargs["numa"] = NUMA_STRATEGIES[numa]
+            print(f"  NUMA strategy: {numa}")
 
+        from llama_cpp import Llama, llama_print_system_info
+
+        # Confirms which SIMD paths (NEON, DOTPROD, SVE, ...) the build actually enabled
+        print(f"  llama.cpp system info: {llama_print_system_info().decode().strip()}")
         llm = Llama(**llama_kwargs)
+        if prompt_cache_mb > 0:
+            from llama_cpp import LlamaRAMCache
+
+            llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache_mb << 20))
+            print(f"  Prompt cache: {prompt_cache_mb} MiB")
         print("Model loaded successfully!")
 
-        # Warm up the model with a tiny inference (non-blocking errors)
+        # Warm up with a single BOS eval: pages in the weights and primes the
+        # compute buffers without the chat template, sampler, or detokenizer
         print("Warming up model...")
         try:
-            llm.create_chat_completion(
-                messages=[{"role": "user", "content": "Hi"}],
-                max_tokens=1,
-                temperature=0.1,
-            )
+            llm.eval(llm.tokenize(b" ", add_bos=True))
+            llm.reset()
             print("Model warm-up complete!")
         except Exception as e:
             print(f"Warm-up warning: {e}")
 
+    # Health bodies only depend on whether the model is loaded; serialize both once
+    health_loaded, health_loading = (
+        orjson.dumps({"status": status, "model": config.model_name, "format": "GGUF"})
+        for status in ("healthy", "loading")
+    )
+
     @app.get("/health")
     async def health():
-        return {
-            "status": "healthy" if llm is not None else "loading",
-            "model": config.model_name,
-            "format": "GGUF",
-        }
+        return Response(content=health_loaded if llm is not None else health_loading, media_type="application/json")
 
     @app.get("/health/details")
     async def health_details():
@@ -214,26 +310,57 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
             "status": "healthy" if llm is not None else "loading",
             "model": config.model_name,
             "format": "GGUF",
-            "repo": os.getenv("MODEL_REPO", config.default_repo),
-            "file": os.getenv("MODEL_FILE", config.default_file),
+            "repo": model_key[0],
+            "file": model_key[1],
             "cpu_count": os.cpu_count(),
             "n_ctx": n_ctx,
             "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
             "n_batch": n_batch,
-            "max_concurrent": max_concurrent,
+            "n_ubatch": n_ubatch,
+            "n_gpu_layers": n_gpu_layers,
+            "use_mlock": use_mlock,
+            "use_mmap": use_mmap,
+            "prompt_cache_mb": prompt_cache_mb,
             "openblas_num_threads": os.getenv("OPENBLAS_NUM_THREADS"),
             "omp_num_threads": os.getenv("OMP_NUM_THREADS"),
             "instance_id": os.getenv("INSTANCE_ID", "1"),
             "git_sha": os.getenv("GITHUB_SHA", os.getenv("GIT_SHA", "unknown")),
         }
 
+    # The model list never changes for the life of the app, so serialize it once
+    models_body = orjson.dumps({
+        "data": [
+            {"id": config.openai_model_id, "object": "model", "owned_by": config.owned_by}
+        ]
+    })
+
     @app.get("/v1/models")
     async def list_models():
-        return {
-            "data": [
-                {"id": config.openai_model_id, "object": "model", "owned_by": config.owned_by}
-            ]
-        }
+        return Response(content=models_body, media_type="application/json")
+
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus text exposition of the request and token counters."""
+        return metrics_response(stats, {"model_loaded": int(llm is not None)})
+
+    async def _run_llm(fn, /, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(llm_executor, functools.partial(fn, *args, **kwargs))
+
+    def _timed(fn, /, *args, **kwargs):
+        """Call fn on the llm thread and return (start_time, result) to split queue vs compute time."""
+        started = time.perf_counter()
+        return started, fn(*args, **kwargs)
+
+    @functools.lru_cache(maxsize=256)
+    def _message_tokens(role: str, content: str) -> int:
+        # Cached per message: chat clients resend the same system prompt and
+        # history every turn, so only the newest message is actually tokenized.
+        return len(llm.tokenize(f"{role}: {content}\n".encode(), add_bos=False, special=True))
+
+    def _count_prompt_tokens(messages: list) -> int:
+        return 1 + sum(_message_tokens(m["role"], m["content"]) for m in messages)  # +1 for BOS
 
     async def _generate_stream(
         messages: list,
@@ -242,43 +369,97 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
         top_p: float,
         *,
         include_perf: bool,
+        http_request: Request,
     ):
         try:
             start_time = time.perf_counter()
-            generated_text = ""
+            # Tokenize the prompt once up front; completion tokens are counted
+            # from the stream itself rather than re-tokenizing the output.
+            prompt_tokens = _count_prompt_tokens(messages)
+            tokenization_done = time.perf_counter()
+            completion_tokens = 0
             first_token_time: Optional[float] = None
-            lock_acquired: float = 0.0
-            generation_done: float = 0.0
-
-            async with inference_lock:
-                lock_acquired = time.perf_counter()
-                response = await asyncio.to_thread(
-                    llm.create_chat_completion,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    stream=True,
-                )
 
-                for chunk in response:
-                    if "choices" in chunk and len(chunk["choices"]) > 0:
-                        delta = chunk["choices"][0].get("delta", {})
-                        if "content" in delta:
-                            content = delta["content"]
-                            generated_text += content
-                            if first_token_time is None and content:
-                                first_token_time = time.perf_counter()
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            await asyncio.sleep(0)
-
-                generation_done = time.perf_counter()
-            # Semaphore released — tokenize outside the lock to unblock concurrent requests
-            prompt_text = "\n".join([f"{m['role']}: {m['content']}" for m in messages])
-            prompt_tokens = len(llm.tokenize(prompt_text.encode()))
-            completion_tokens = len(llm.tokenize(generated_text.encode()))
+            # The stream iterator decodes lazily, so the whole generation runs as
+            # one job on the llm thread and hands chunks back through a bounded
+            # queue; a slow client back-pressures the producer.
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+            stop = threading.Event()
+
+            def _put(item) -> None:
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+            def _produce():
+                # Abandoned while queued behind other requests: skip the prefill
+                if stop.is_set():
+                    return
+                try:
+                    for chunk in llm.create_chat_completion(
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        stream=True,
+                    ):
+                        if stop.is_set():
+                            break
+                        _put(chunk)
+                finally:
+                    if not stop.is_set():
+                        _put(None)
+
+            producer = asyncio.ensure_future(_run_llm(_timed, _produce))
+            # Not awaited when the client leaves early; retrieve its exception so it isn't reported as unhandled
+            producer.add_done_callback(lambda f: f.cancelled() or f.exception())
+            held: list = []
+
+            try:
+                while True:
+                    if held:
+                        chunk = held.pop()
+                    else:
+                        try:
+                            chunk = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                        except TimeoutError:
+                            if await http_request.is_disconnected():
+                                return
+                            yield SSE_KEEPALIVE
+                            continue
+                    if chunk is None:
+                        break
+                    content = _delta_content(chunk)
+                    if content is not None:
+                        # llama-cpp-python emits one chunk per sampled token
+                        completion_tokens += 1
+                        if first_token_time is None and content:
+                            first_token_time = time.perf_counter()
+                        # Tokens already waiting in the queue go out in this frame
+                        # rather than one frame (and write) each; never waits for more
+                        parts = [content]
+                        while len(parts) < sse_batch and not queue.empty():
+                            nxt = queue.get_nowait()
+                            nxt_content = _delta_content(nxt)
+                            if nxt_content is None:
+                                held.append(nxt)
+                                break
+                            parts.append(nxt_content)
+                            completion_tokens += 1
+                        if len(parts) > 1:
+                            chunk["choices"][0]["delta"]["content"] = "".join(parts)
+                        yield _sse(chunk)
+            finally:
+                # On early exit (client gone), stop the producer at its next token
+                # and unblock it if it is waiting on a full queue
+                stop.set()
+                while not queue.empty():
+                    queue.get_nowait()
+
+            generation_done = time.perf_counter()
+            compute_start, _ = await producer
             total_tokens = prompt_tokens + completion_tokens
-            tokenization_done = time.perf_counter()
+            stats["prompt_tokens_total"] += prompt_tokens
+            stats["completion_tokens_total"] += completion_tokens
 
             usage_chunk = {
                 "choices": [{"delta": {}, "finish_reason": "stop"}],
@@ -290,10 +471,10 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
             }
 
             if include_perf:
-                queue_ms = int((lock_acquired - start_time) * 1000)
-                total_ms = int((tokenization_done - start_time) * 1000)
-                generation_ms = int((generation_done - lock_acquired) * 1000)
-                tokenize_ms = int((tokenization_done - generation_done) * 1000)
+                tokenize_ms = int((tokenization_done - start_time) * 1000)
+                queue_ms = int((compute_start - tokenization_done) * 1000)
+                total_ms = int((generation_done - start_time) * 1000)
+                generation_ms = int((generation_done - compute_start) * 1000)
                 ttft_ms = (
                     int((first_token_time - start_time) * 1000)
                     if first_token_time is not None
@@ -314,34 +495,37 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
                     "n_ctx": n_ctx,
                     "n_threads": n_threads,
                     "n_batch": n_batch,
-                    "max_concurrent": max_concurrent,
+                    "n_ubatch": n_ubatch,
                 }
 
                 if log_perf:
                     print(f"perf stream queue_ms={queue_ms} ttft_ms={ttft_ms} gen_ms={generation_ms} tok_ms={tokenize_ms} total_ms={total_ms} completion_tokens={completion_tokens} completion_tps={completion_tps}")
 
-            yield f"data: {json.dumps(usage_chunk)}\n\n"
-            yield "data: [DONE]\n\n"
+            yield _sse(usage_chunk)
+            yield SSE_DONE
         except Exception as e:
+            stats["errors_total"] += 1
             print(f"Stream error: {e}")
-            yield f"data: {json.dumps({'error': 'Generation failed'})}\n\n"
+            yield _sse({"error": "Generation failed"})
 
     @app.post("/v1/chat/completions")
-    async def chat_completions(request: GenerateRequest):
+    async def chat_completions(request: GenerateRequest, http_request: Request):
         if llm is None:
             raise HTTPException(status_code=503, detail="Model not loaded")
 
+        stats["requests_total"] += 1
         try:
             include_perf = bool(request.include_perf) or always_include_perf
             request_start = time.perf_counter()
             if request.messages:
-                messages = [{"role": m.role, "content": m.content} for m in request.messages]
+                messages = request.model_dump(include={"messages"})["messages"]
             elif request.prompt:
                 messages = [{"role": "user", "content": request.prompt}]
             else:
                 raise HTTPException(status_code=400, detail="Either messages or prompt required")
 
             if request.stream:
+                stats["stream_requests_total"] += 1
                 return StreamingResponse(
                     _generate_stream(
                         messages,
@@ -349,21 +533,21 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
                         request.temperature,
                         request.top_p,
                         include_perf=include_perf,
+                        http_request=http_request,
                     ),
                     media_type="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
+                    headers={"Cache-Control": "no-cache, no-transform", "Connection": "keep-alive", "X-Accel-Buffering": "no"},
                 )
 
             wait_start = time.perf_counter()
-            async with inference_lock:
-                lock_acquired = time.perf_counter()
-                response = await asyncio.to_thread(
-                    llm.create_chat_completion,
-                    messages=messages,
-                    max_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                )
+            compute_start, response = await _run_llm(
+                _timed,
+                llm.create_chat_completion,
+                messages=messages,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+            )
             done = time.perf_counter()
 
             result = {
@@ -373,10 +557,12 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
                 "choices": response["choices"],
                 "usage": response["usage"],
             }
+            stats["prompt_tokens_total"] += response["usage"].get("prompt_tokens", 0)
+            stats["completion_tokens_total"] += response["usage"].get("completion_tokens", 0)
 
             if include_perf:
-                queue_ms = int((lock_acquired - wait_start) * 1000)
-                compute_ms = int((done - lock_acquired) * 1000)
+                queue_ms = int((compute_start - wait_start) * 1000)
+                compute_ms = int((done - compute_start) * 1000)
                 total_ms = int((done - request_start) * 1000)
                 usage = response.get("usage") or {}
                 completion_tokens = usage.get("completion_tokens")
@@ -393,14 +579,17 @@ def create_inference_app(config: InferenceAppConfig) -> FastAPI:
                     "n_ctx": n_ctx,
                     "n_threads": n_threads,
                     "n_batch": n_batch,
-                    "max_concurrent": max_concurrent,
+                    "n_ubatch": n_ubatch,
                 }
 
                 if log_perf:
                     print(f"perf queue_ms={queue_ms} compute_ms={compute_ms} total_ms={total_ms} completion_tokens={completion_tokens} completion_tps={completion_tps}")
 
-            return result
+            return json_response(orjson.dumps(result), http_request.headers.get("accept-encoding", ""))
+        except HTTPException:
+            raise
         except Exception as e:
+            stats["errors_total"] += 1
             print(f"Completion error: {e}")
             raise HTTPException(status_code=500, detail="Generation failed")
 
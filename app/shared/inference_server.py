@@ -17,4 +17,6 @@ app = create_app_for_model(MODEL_NAME)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # One worker: each extra process would load its own copy of the model weights
+    # Keep-alive outlives cloudflared's 90s idle origin connections instead of uvicorn's 5s
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools", backlog=2048, timeout_keep_alive=100)
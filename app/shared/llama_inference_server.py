@@ -21,4 +21,14 @@ m = get_model(MODEL_NAME)
 app = create_llama_server_app_for_model(MODEL_NAME)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", str(m.port))))
+    # One worker: the process owns the llama-server subprocess and its port
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", str(m.port))),
+        loop="uvloop",
+        http="httptools",
+        backlog=2048,
+        # Outlive cloudflared's 90s idle origin connections instead of uvicorn's 5s
+        timeout_keep_alive=100,
+    )
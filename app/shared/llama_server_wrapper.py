@@ -1,25 +1,51 @@
 """Shared llama-server subprocess wrapper for native llama.cpp inference."""
 
 import atexit
+import hashlib
 import logging
 import os
 import signal
 import subprocess
 import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional
 
 import httpx
-from fastapi import FastAPI, HTTPException, Request
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from huggingface_hub import hf_hub_download
+
+from shared.server_utils import json_response, metrics_response, mlock_fits, prefetch_model
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 LLAMA_SERVER_PORT = 8080
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Keep reverse proxies (nginx, cloudflared) from buffering SSE into large chunks
+SSE_HEADERS = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that always runs `on_close` once it is done sending.
+
+    A generator's own `finally` never runs if the client disconnects before
+    Starlette starts iterating it, so resources held for the stream are released
+    here instead.
+    """
+
+    def __init__(self, content, *, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
 
 
 @dataclass
@@ -32,11 +58,16 @@ class LlamaServerConfig:
     default_port: int
     n_ctx: int = 4096
     n_threads: int = 4
-    n_batch: int = 256
+    n_batch: int = 2048
+    n_ubatch: int = 512
     max_concurrent: int = 2
     startup_timeout: int = 300
     flash_attn: bool = True
     kv_cache_quant: bool = True
+    use_mlock: bool = False
+    use_mmap: bool = True
+    response_cache_size: int = 1024
+    max_queue: int = 8
     extra_args: Optional[List[str]] = None
 
 
@@ -46,12 +77,41 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
     model_file = os.getenv("MODEL_FILE", config.default_file)
     n_ctx = int(os.getenv("N_CTX", str(config.n_ctx)))
     n_threads = int(os.getenv("N_THREADS", str(config.n_threads)))
+    # --threads-batch for prompt prefill; same as --threads unless overridden
+    n_threads_batch = int(os.getenv("N_THREADS_BATCH", str(n_threads)))
     n_batch = int(os.getenv("N_BATCH", str(config.n_batch)))
+    n_ubatch = int(os.getenv("N_UBATCH", str(config.n_ubatch)))
+    # Layers offloaded to the GPU (-1 = all); only takes effect in a CUDA/Metal build
+    n_gpu_layers = int(os.getenv("N_GPU_LAYERS", "0"))
     max_concurrent = int(os.getenv("MAX_CONCURRENT", str(config.max_concurrent)))
+    # Requests beyond the slots plus this many waiting ones are shed with a 503
+    # instead of piling up behind llama-server's slots and blowing tail latency
+    max_queue = int(os.getenv("MAX_QUEUE", str(config.max_queue)))
+    # llama-server splits --ctx-size evenly across --parallel slots, so size the
+    # shared context so that every continuous-batching slot gets the full n_ctx
+    ctx_size = n_ctx * max_concurrent
     kv_cache_quant = os.getenv("KV_CACHE_QUANT", "true" if config.kv_cache_quant else "false").lower() in {"1", "true", "yes", "on"}
     flash_attn = os.getenv("FLASH_ATTN", "true" if config.flash_attn else "false").lower() in {"1", "true", "yes", "on"}
+    use_mlock = os.getenv("USE_MLOCK", "true" if config.use_mlock else "false").lower() in {"1", "true", "yes", "on"}
+    use_mmap = os.getenv("USE_MMAP", "true" if config.use_mmap else "false").lower() in {"1", "true", "yes", "on"}
+    # NUMA placement (distribute/isolate/numactl) only pays off on multi-socket hosts
+    numa = os.getenv("NUMA", "").strip().lower()
+    # Slots already keep their last prompt; CACHE_REUSE > 0 also lets a slot reuse
+    # matching chunks of at least that many tokens from further down its cache
+    cache_reuse = int(os.getenv("CACHE_REUSE", "0"))
     hf_token = os.getenv("HF_TOKEN")
     startup_timeout = int(os.getenv("STARTUP_TIMEOUT", str(config.startup_timeout)))
+    # Greedy (temperature 0) non-stream replies are deterministic, so retries and
+    # fan-out of identical prompts can be answered without touching llama-server
+    response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", str(config.response_cache_size)))
+    response_cache: "OrderedDict[str, bytes]" = OrderedDict()
+    # Each in-flight stream holds one HTTP/1.1 connection to llama-server, so keep
+    # enough warm connections for every slot plus queued requests
+    http_limits = httpx.Limits(
+        max_connections=max(64, max_concurrent * 8),
+        max_keepalive_connections=max(32, max_concurrent * 4),
+        keepalive_expiry=120,
+    )
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
@@ -62,7 +122,8 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
         llama_process = await asyncio.to_thread(start_llama_server, model_path)
         http_client = httpx.AsyncClient(
             base_url=f"http://127.0.0.1:{LLAMA_SERVER_PORT}",
-            timeout=300.0,
+            timeout=httpx.Timeout(connect=5.0, read=300.0, write=60.0, pool=5.0),
+            limits=http_limits,
         )
         atexit.register(cleanup)
         signal.signal(signal.SIGTERM, lambda s, f: cleanup())
@@ -87,6 +148,15 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
     llama_process: Optional[subprocess.Popen] = None
     http_client: Optional[httpx.AsyncClient] = None
     server_log_file: Optional[object] = None
+    inflight = 0
+    # Cumulative counters exported on /metrics
+    stats = {
+        "requests_total": 0,
+        "stream_requests_total": 0,
+        "rejected_total": 0,
+        "cache_hits_total": 0,
+        "upstream_errors_total": 0,
+    }
 
     def check_llama_server():
         llama_path = "/usr/local/bin/llama-server"
@@ -105,6 +175,9 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             logger.warning(f"Could not get llama-server version: {e}")
 
     def download_model() -> str:
+        nonlocal use_mlock
+        from huggingface_hub import hf_hub_download
+
         cache_dir = os.getenv("HF_HOME", "/app/.cache/huggingface")
 
         logger.info(f"Downloading model: {model_repo}/{model_file}")
@@ -115,6 +188,10 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             token=hf_token,
         )
         logger.info(f"Model downloaded to: {model_path}")
+        if use_mmap:
+            prefetch_model(model_path)
+        if use_mlock:
+            use_mlock = mlock_fits(model_path)
         return model_path
 
     log_path = "/tmp/llama-server.log"
@@ -132,9 +209,11 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             "--model", model_path,
             "--host", "127.0.0.1",
             "--port", str(LLAMA_SERVER_PORT),
-            "--ctx-size", str(n_ctx),
+            "--ctx-size", str(ctx_size),
             "--threads", str(n_threads),
+            "--threads-batch", str(n_threads_batch),
             "--batch-size", str(n_batch),
+            "--ubatch-size", str(n_ubatch),
             "--parallel", str(max_concurrent),
             "--cont-batching",
         ]
@@ -145,6 +224,22 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
         if kv_cache_quant:
             cmd.extend(["--cache-type-k", "q8_0", "--cache-type-v", "q8_0"])
 
+        if use_mlock:
+            cmd.append("--mlock")
+
+        if not use_mmap:
+            cmd.append("--no-mmap")
+
+        if n_gpu_layers:
+            # llama-server wants a count; anything above the layer count offloads every layer
+            cmd.extend(["--n-gpu-layers", str(n_gpu_layers if n_gpu_layers >= 0 else 999)])
+
+        if numa:
+            cmd.extend(["--numa", numa])
+
+        if cache_reuse > 0:
+            cmd.extend(["--cache-reuse", str(cache_reuse)])
+
         if config.extra_args:
             cmd.extend(config.extra_args)
 
@@ -161,29 +256,37 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             bufsize=1,
         )
 
-        start_time = time.time()
-        check_count = 0
-
-        while time.time() - start_time < startup_timeout:
-            check_count += 1
-            elapsed = int(time.time() - start_time)
-
-            try:
-                response = httpx.get(f"http://127.0.0.1:{LLAMA_SERVER_PORT}/health", timeout=2)
-                if response.status_code == 200:
-                    logger.info(f"llama-server is ready (took {elapsed}s)")
-                    return process
-                if response.status_code == 503 and check_count % 10 == 0:
-                    logger.info(f"llama-server still loading model... ({elapsed}s elapsed)")
-            except Exception:
-                if check_count % 10 == 0:
-                    logger.info(f"Waiting for llama-server to start... ({elapsed}s elapsed)")
-
-            if process.poll() is not None:
-                logger.error(f"llama-server died (exit code: {process.returncode})\n{read_server_log()}")
-                raise RuntimeError(f"llama-server failed to start (exit code: {process.returncode})")
-
-            time.sleep(1)
+        start_time = time.monotonic()
+        last_log = start_time
+        # Poll fast at first and back off to 250ms, reusing one keep-alive
+        # connection, so readiness is noticed soon after the model finishes loading
+        delay = 0.05
+
+        with httpx.Client(base_url=f"http://127.0.0.1:{LLAMA_SERVER_PORT}", timeout=2) as client:
+            while time.monotonic() - start_time < startup_timeout:
+                now = time.monotonic()
+                elapsed = int(now - start_time)
+                log_due = now - last_log >= 10
+
+                try:
+                    response = client.get("/health")
+                    if response.status_code == 200:
+                        logger.info(f"llama-server is ready (took {now - start_time:.1f}s)")
+                        return process
+                    if response.status_code == 503 and log_due:
+                        logger.info(f"llama-server still loading model... ({elapsed}s elapsed)")
+                        last_log = now
+                except Exception:
+                    if log_due:
+                        logger.info(f"Waiting for llama-server to start... ({elapsed}s elapsed)")
+                        last_log = now
+
+                if process.poll() is not None:
+                    logger.error(f"llama-server died (exit code: {process.returncode})\n{read_server_log()}")
+                    raise RuntimeError(f"llama-server failed to start (exit code: {process.returncode})")
+
+                time.sleep(delay)
+                delay = min(delay * 1.5, 0.25)
 
         logger.error(f"llama-server timeout after {startup_timeout}s\n{read_server_log()}")
         raise RuntimeError(f"llama-server did not become healthy in {startup_timeout}s")
@@ -204,6 +307,8 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
                 pass
             server_log_file = None
 
+    health_body = orjson.dumps({"status": "healthy", "model": config.display_name, "format": "GGUF"})
+
     @app.get("/health")
     async def health():
         if llama_process is None or llama_process.poll() is not None:
@@ -217,7 +322,7 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
         if response.status_code != 200:
             raise HTTPException(status_code=503, detail="llama-server unhealthy")
 
-        return {"status": "healthy", "model": config.display_name, "format": "GGUF"}
+        return Response(content=health_body, media_type="application/json")
 
     @app.get("/health/details")
     async def health_details():
@@ -229,10 +334,23 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             "repo": model_repo,
             "file": model_file,
             "n_ctx": n_ctx,
+            "ctx_size": ctx_size,
             "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
             "n_batch": n_batch,
+            "n_ubatch": n_ubatch,
+            "n_gpu_layers": n_gpu_layers,
             "max_concurrent": max_concurrent,
+            "max_queue": max_queue,
+            "inflight": inflight,
+            "max_connections": http_limits.max_connections,
+            "max_keepalive_connections": http_limits.max_keepalive_connections,
             "kv_cache_quant": kv_cache_quant,
+            "use_mlock": use_mlock,
+            "use_mmap": use_mmap,
+            "cache_reuse": cache_reuse,
+            "response_cache_size": response_cache_size,
+            "response_cache_entries": len(response_cache),
             "cpu_count": os.cpu_count(),
             "openblas_num_threads": os.getenv("OPENBLAS_NUM_THREADS"),
             "omp_num_threads": os.getenv("OMP_NUM_THREADS"),
@@ -240,61 +358,143 @@ def create_llama_server_app(config: LlamaServerConfig) -> FastAPI:
             "git_sha": os.getenv("GITHUB_SHA", os.getenv("GIT_SHA", "unknown")),
         }
 
+    # The model list never changes for the life of the app, so serialize it once
+    models_body = orjson.dumps({
+        "object": "list",
+        "data": [
+            {
+                "id": config.model_id,
+                "object": "model",
+                "created": int(time.time()),
+                "owned_by": config.owned_by,
+            }
+        ]
+    })
+
     @app.get("/v1/models")
     async def list_models():
-        return {
-            "object": "list",
-            "data": [
-                {
-                    "id": config.model_id,
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": config.owned_by,
-                }
-            ]
-        }
+        return Response(content=models_body, media_type="application/json")
+
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus text exposition of the proxy's load and request counters."""
+        return metrics_response(stats, {"inflight": inflight, "response_cache_entries": len(response_cache)})
 
-    def validate_proxy_response(response: httpx.Response) -> dict:
+    def validate_proxy_response(response: httpx.Response) -> None:
+        """Check that the upstream reply is a successful completion."""
         if response.status_code != 200:
+            stats["upstream_errors_total"] += 1
             raise HTTPException(status_code=response.status_code, detail=response.text)
-        data = response.json()
+        try:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            data = None
         if not isinstance(data, dict) or "choices" not in data:
+            stats["upstream_errors_total"] += 1
             raise HTTPException(status_code=502, detail="Invalid response from model server")
-        return data
+
+    def cache_key(path: str, body: dict) -> Optional[str]:
+        """Key deterministic requests on their canonical JSON; None when not cacheable."""
+        if response_cache_size <= 0 or body.get("temperature") != 0:
+            return None
+        canonical = orjson.dumps(body, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(path.encode() + b"|" + canonical).hexdigest()
+
+    def acquire_slot() -> None:
+        nonlocal inflight
+        if inflight >= max_concurrent + max_queue:
+            stats["rejected_total"] += 1
+            raise HTTPException(status_code=503, detail="Server busy", headers={"Retry-After": "1"})
+        inflight += 1
+
+    def release_slot() -> None:
+        nonlocal inflight
+        inflight -= 1
+
+    async def proxy_json(request: Request, path: str, raw: bytes, body: dict) -> Response:
+        """Forward a non-stream request, passing the upstream JSON bytes through without re-encoding."""
+        accept_encoding = request.headers.get("accept-encoding", "")
+        key = cache_key(path, body)
+        if key is not None and key in response_cache:
+            stats["cache_hits_total"] += 1
+            response_cache.move_to_end(key)
+            return json_response(response_cache[key], accept_encoding, {"X-Cache": "HIT"})
+
+        acquire_slot()
+        try:
+            response = await http_client.post(path, content=raw, headers=JSON_HEADERS)
+        finally:
+            release_slot()
+        validate_proxy_response(response)
+        if key is None:
+            return json_response(response.content, accept_encoding)
+
+        response_cache[key] = response.content
+        if len(response_cache) > response_cache_size:
+            response_cache.popitem(last=False)
+        return json_response(response.content, accept_encoding, {"X-Cache": "MISS"})
+
+    async def read_body(request: Request) -> tuple[bytes, dict]:
+        raw = await request.body()
+        try:
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Request body must be JSON")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+        return raw, body
 
     @app.post("/v1/chat/completions")
     async def chat_completions(request: Request):
-        body = await request.json()
+        raw, body = await read_body(request)
         stream = body.get("stream", False)
+        stats["requests_total"] += 1
 
         if stream:
-            async def stream_response():
-                async with http_client.stream(
-                    "POST",
-                    "/v1/chat/completions",
-                    json=body,
-                ) as response:
-                    if response.status_code != 200:
-                        await response.aread()
-                        error_event = f'data: {{"error": true, "content": "Model error: {response.status_code}"}}\n\n'
-                        yield error_event.encode()
-                        return
-                    async for chunk in response.aiter_bytes():
-                        yield chunk
-
-            return StreamingResponse(
-                stream_response(),
-                media_type="text/event-stream",
+            stats["stream_requests_total"] += 1
+            # Open the upstream stream before responding so its status code reaches the client
+            acquire_slot()
+            try:
+                upstream = await http_client.send(
+                    http_client.build_request("POST", "/v1/chat/completions", content=raw, headers=JSON_HEADERS),
+                    stream=True,
+                )
+            except BaseException:
+                release_slot()
+                raise
+            if upstream.status_code != 200:
+                stats["upstream_errors_total"] += 1
+                release_slot()
+                try:
+                    await upstream.aread()
+                finally:
+                    await upstream.aclose()
+                raise HTTPException(status_code=upstream.status_code, detail=upstream.text)
+
+            released = False
+
+            async def close_upstream() -> None:
+                nonlocal released
+                if released:
+                    return
+                released = True
+                release_slot()
+                await upstream.aclose()
+
+            return ClosingStreamingResponse(
+                upstream.aiter_bytes(),
+                on_close=close_upstream,
+                media_type=upstream.headers.get("content-type", "text/event-stream"),
+                headers=SSE_HEADERS,
             )
 
-        response = await http_client.post("/v1/chat/completions", json=body)
-        return validate_proxy_response(response)
+        return await proxy_json(request, "/v1/chat/completions", raw, body)
 
     @app.post("/v1/completions")
     async def completions(request: Request):
-        body = await request.json()
-        response = await http_client.post("/v1/completions", json=body)
-        return validate_proxy_response(response)
+        raw, body = await read_body(request)
+        stats["requests_total"] += 1
+        return await proxy_json(request, "/v1/completions", raw, body)
 
     return app
 
@@ -314,8 +514,11 @@ def create_llama_server_app_for_model(model_name: str) -> FastAPI:
         n_ctx=m.n_ctx,
         n_threads=m.n_threads,
         n_batch=m.n_batch,
+        n_ubatch=m.n_ubatch,
         max_concurrent=m.max_concurrent,
         flash_attn=m.flash_attn,
         kv_cache_quant=m.kv_cache_quant,
+        use_mlock=m.use_mlock,
+        use_mmap=m.use_mmap,
     )
     return create_llama_server_app(config)
@@ -0,0 +1,70 @@
+"""Helpers shared by the llama-cpp-python and llama-server inference apps."""
+
+import gzip
+import logging
+import os
+from typing import Optional
+
+from fastapi import Response
+
+logger = logging.getLogger(__name__)
+
+# Non-stream JSON bodies at least this large are gzipped for clients that accept
+# it; SSE is never compressed so tokens keep flushing one frame at a time
+GZIP_MIN_SIZE = 1024
+
+
+def json_response(content: bytes, accept_encoding: str, headers: Optional[dict] = None) -> Response:
+    headers = dict(headers or {})
+    if len(content) >= GZIP_MIN_SIZE and "gzip" in accept_encoding:
+        content = gzip.compress(content, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+def metrics_response(stats: dict, gauges: Optional[dict] = None) -> Response:
+    """Prometheus text exposition of point-in-time gauges and cumulative counters, prefixed llm_."""
+    lines = []
+    for name, value in (gauges or {}).items():
+        lines += [f"# TYPE llm_{name} gauge", f"llm_{name} {value}"]
+    for name, value in stats.items():
+        lines += [f"# TYPE llm_{name} counter", f"llm_{name} {value}"]
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+def prefetch_model(model_path: str) -> None:
+    """Start async readahead of the GGUF so mmap'd weights aren't faulted in page by page."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(model_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Could not prefetch model file: {e}")
+
+
+def mlock_fits(model_path: str) -> bool:
+    """Whether the GGUF can be pinned: within RLIMIT_MEMLOCK and leaving a quarter of available RAM free."""
+    size = os.path.getsize(model_path)
+    try:
+        import resource
+
+        soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        if soft != resource.RLIM_INFINITY and soft < size:
+            logger.warning(f"mlock disabled: RLIMIT_MEMLOCK ({soft} bytes) is below the model size ({size} bytes)")
+            return False
+    except (ImportError, OSError, ValueError):
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            available = next(int(line.split()[1]) * 1024 for line in f if line.startswith("MemAvailable:"))
+    except (OSError, StopIteration, ValueError):
+        return True
+    if size > available * 0.75:
+        logger.warning(f"mlock disabled: model ({size} bytes) would leave too little of {available} bytes available")
+        return False
+    return True
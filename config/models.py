@@ -42,10 +42,16 @@ class ModelConfig:
     workflow_file: str | None = None
     n_ctx: int = 4096
     n_threads: int = 4
-    n_batch: int = 256
+    n_batch: int = 2048
+    n_ubatch: int = 512
+    # llama-server parallel slots; the llama-cpp-python image serves one request at a time
     max_concurrent: int = 2
     kv_cache_quant: bool = True
     flash_attn: bool = True
+    # Pin weights in RAM: worth it for small models, but 8B+ models should stay
+    # pageable so mlock doesn't starve the runner of memory
+    use_mlock: bool = False
+    use_mmap: bool = True
     # Routing category for auto-routing (general/coding/reasoning/function_calling)
     routing_category: str | None = None
     # Dockerfile variant: "inference" (llama-cpp-python) or "llama-server" (builds from source)
@@ -117,8 +123,7 @@ MODELS: dict[str, ModelConfig] = {
         hf_repo="unsloth/SmolLM3-3B-GGUF",
         hf_file="SmolLM3-3B-Q4_K_M.gguf",
         owned_by="huggingfacetb",
-        n_batch=512,
-        max_concurrent=3,
+        use_mlock=True,
         routing_category="function_calling",
     ),
     "lfm2": ModelConfig(
@@ -150,7 +155,6 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="LFM2.5-350M-Q4_K_M.gguf",
         owned_by="liquidai",
         n_ctx=8192,
-        n_batch=512,
         max_concurrent=4,
         routing_category="general",
         dockerfile="llama-server",
@@ -168,7 +172,6 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="lfm2-350m.Q4_K_M.gguf",
         owned_by="signal38",
         n_ctx=8192,
-        n_batch=512,
         max_concurrent=4,
         routing_category="general",
         dockerfile="llama-server",
@@ -186,7 +189,6 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="LFM2-350M-StepGame-f16.gguf",
         owned_by="liquidai",
         n_ctx=8192,
-        n_batch=512,
         max_concurrent=4,
         routing_category="general",
         dockerfile="llama-server",
@@ -204,8 +206,7 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="Phi-4-mini-reasoning-Q4_K_M.gguf",
         owned_by="microsoft",
         n_ctx=8192,
-        n_batch=512,
-        max_concurrent=3,
+        use_mlock=True,
         routing_category="reasoning",
     ),
     "lfm2thinking": ModelConfig(
@@ -237,7 +238,6 @@ MODELS: dict[str, ModelConfig] = {
         hf_repo="janhq/Jan-code-4b-gguf",
         hf_file="Jan-code-4b-Q4_K_M.gguf",
         owned_by="janhq",
-        n_batch=512,
         max_concurrent=3,
         routing_category="coding",
         dockerfile="llama-server",
@@ -272,6 +272,7 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="Qwen3.5-27B.Q4_K_M.gguf",
         owned_by="jackrong",
         n_ctx=8192,
+        n_batch=512,
         max_concurrent=1,
         routing_category="reasoning",
         dockerfile="llama-server",
@@ -304,8 +305,7 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="gemma-3n-E4B-it-Q4_K_M.gguf",
         owned_by="google",
         n_ctx=8192,
-        n_batch=256,
-        max_concurrent=2,
+        n_batch=512,
         routing_category="general",
     ),
     # Reasoning models
@@ -322,8 +322,7 @@ MODELS: dict[str, ModelConfig] = {
         hf_file="Nanbeige4.1-3B.Q4_K_M.gguf",
         owned_by="nanbeige",
         n_ctx=2048,
-        n_batch=512,
-        max_concurrent=4,
+        use_mlock=True,
         routing_category="reasoning",
     ),
     "gptoss": ModelConfig(
@@ -435,9 +434,12 @@ if __name__ == "__main__":
                     "n_ctx": m.n_ctx,
                     "n_threads": m.n_threads,
                     "n_batch": m.n_batch,
+                    "n_ubatch": m.n_ubatch,
                     "max_concurrent": m.max_concurrent,
                     "kv_cache_quant": m.kv_cache_quant,
                     "flash_attn": m.flash_attn,
+                    "use_mlock": m.use_mlock,
+                    "use_mmap": m.use_mmap,
                     "dockerfile": m.dockerfile,
                 }))
         except KeyError as e:
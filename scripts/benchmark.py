@@ -39,6 +39,10 @@ RESULT_FILE = Path("/tmp/benchmark-result.json")
 # Warmup probe sent before the suites. If it returns empty, the model is skipped.
 WARMUP_PROMPT = "Respond with exactly one word: hello."
 
+# One keep-alive session for every registry call, so per-prompt latency doesn't
+# include a fresh TCP + TLS handshake to the tunnel edge.
+SESSION = requests.Session()
+
 
 # ---------------------------------------------------------------------------
 # Prompt suites
@@ -91,7 +95,7 @@ SUITES = [
 
 def get_online_models():
     try:
-        res = requests.get(f"{REGISTRY}/v1/models", timeout=10)
+        res = SESSION.get(f"{REGISTRY}/v1/models", timeout=10)
         res.raise_for_status()
         return [m["id"] for m in res.json().get("data", [])]
     except Exception as e:
@@ -116,37 +120,39 @@ def run_prompt(model_id, prompt):
     }
     t0 = time.monotonic()
     try:
-        res = requests.post(
+        with SESSION.post(
             f"{REGISTRY}/v1/chat/completions",
             json=payload,
             timeout=TIMEOUT,
             stream=True,
-        )
-        res.raise_for_status()
-
-        text = ""
-        completion_chunks = 0
-        usage_tokens = None
-
-        for raw in res.iter_lines():
-            if not raw:
-                continue
-            line = raw.decode("utf-8") if isinstance(raw, bytes) else raw
-            if not line.startswith("data: "):
-                continue
-            data = line[6:]
-            if data == "[DONE]":
-                break
-            try:
-                chunk = json.loads(data)
-                delta = chunk["choices"][0]["delta"].get("content") or ""
-                if delta:
-                    text += delta
-                    completion_chunks += 1
-                if chunk.get("usage") and chunk["usage"].get("completion_tokens"):
-                    usage_tokens = chunk["usage"]["completion_tokens"]
-            except Exception:
-                pass
+        ) as res:
+            res.raise_for_status()
+
+            text = ""
+            completion_chunks = 0
+            usage_tokens = None
+
+            for raw in res.iter_lines():
+                if not raw:
+                    continue
+                line = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                # Keep reading to the end of the body: leaving early closes the
+                # socket instead of returning the connection to the pool
+                if data == "[DONE]":
+                    continue
+                try:
+                    chunk = json.loads(data)
+                    delta = chunk["choices"][0]["delta"].get("content") or ""
+                    if delta:
+                        text += delta
+                        completion_chunks += 1
+                    if chunk.get("usage") and chunk["usage"].get("completion_tokens"):
+                        usage_tokens = chunk["usage"]["completion_tokens"]
+                except Exception:
+                    pass
 
         latency_ms = (time.monotonic() - t0) * 1000
         if usage_tokens is not None:
@@ -288,7 +294,7 @@ def push_to_kv(model_id, metrics):
         for name, suite in metrics.get("suites", {}).items()
     }
     try:
-        res = requests.put(
+        res = SESSION.put(
             f"{REGISTRY}/benchmark/{model_id}",
             data=json.dumps(payload),
             headers={"Authorization": f"Bearer {WRITE_KEY}", "Content-Type": "application/json"},